@@ -1,100 +1,405 @@
 """AI Client for LLM-powered threat generation using LiteLLM."""
 
-import json
-import re
+import os
+import asyncio
 import logging
+import functools
+import hashlib
+import time
+import tempfile
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional
 import litellm
+import orjson
 from models import AIThreatsResponseList
-from utils import handle_user_friendly_error
+from utils import _EMPTY, TRUST_BOUNDARY_SHAPES, handle_user_friendly_error, is_threat_eligible
+
+# Process-wide LiteLLM settings, applied once at import
+litellm.drop_params = True
+litellm.suppress_debug_info = True
+litellm.telemetry = False
 
 PROJECT_ROOT = Path(__file__).parent.parent
 PROMPT_FILE = PROJECT_ROOT / "prompt.txt"
 
+# Cell fields the prompt relies on; visual styling (attrs, zIndex, ports, ...) only costs input tokens
+PROMPT_CELL_FIELDS = ('id', 'shape', 'position', 'size', 'vertices', 'source', 'target', 'data')
+
+# Cell data fields written back by this tool (see utils.update_threats); left out of
+# cache keys so re-running on an updated model file still hits the cache
+TOOL_WRITTEN_FIELDS = frozenset({'threats', 'hasOpenThreats'})
+
 
-def generate_threats(schema: Dict, model: Dict, model_name: str, api_key: str, temperature: float = 0.1, response_format: bool = False, api_base: str = None) -> Dict[str, List[Dict]]:
+def generate_threats(schema: Dict, model: Dict, model_name: str, api_key: str, temperature: float = 0.1, response_format: bool = False, api_bases: List[str] = None, stream: bool = False) -> Dict[str, List[Dict]]:
     """Generate AI-powered threats for all in-scope components."""
+    return asyncio.run(generate_threats_async(schema, model, model_name, api_key, temperature, response_format, api_bases, stream))
+
+
+async def generate_threats_async(schema: Dict, model: Dict, model_name: str, api_key: str, temperature: float = 0.1, response_format: bool = False, api_bases: List[str] = None, stream: bool = False) -> Dict[str, List[Dict]]:
+    """Generate threats with concurrent LLM calls, each covering a small batch of in-scope components."""
     logger = logging.getLogger("threat_modeling.ai_client")
     logger.info("Starting threat generation...")
-    
+
+    # In-scope elements are split into batches; each batch is one request whose
+    # prompt carries only the batch's neighbourhood of the model (see _prompt_model)
+    element_ids = _get_in_scope_cell_ids(model)
+    batch_size = max(1, int(os.getenv("LLM_BATCH_SIZE", "10")))
+    batches = [element_ids[i:i + batch_size] for i in range(0, len(element_ids), batch_size)]
+    # At least one request must be allowed in flight, otherwise the semaphore never opens
+    concurrency = max(1, int(os.getenv("LLM_CONCURRENCY", "8")))
+
     # Load prompt template and inject schema/model data
-    prompt_template = PROMPT_FILE.read_text(encoding='utf-8')
-    
-    system_prompt = prompt_template.format(
-        schema_json=json.dumps(schema, indent=2),
-        model_json=json.dumps(model, indent=2),
-    )
-    
+    template = _load_prompt_template()
+    schema_json = _dumps(schema)
+    requests = [_build_messages(template, schema_json, model, batch) for batch in batches]
+
+    # Optional on-disk cache of validated responses; entries expire after LLM_CACHE_TTL seconds
+    cache_dir = Path(os.environ["LLM_CACHE_DIR"]) if os.getenv("LLM_CACHE_DIR") else None
+    cache_ttl = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+    if cache_dir:
+        cache_dir.mkdir(parents=True, exist_ok=True)
 
     logger.info(f"Calling LLM: {model_name}")
+    logger.info(f"Elements to analyze: {len(element_ids)} in {len(batches)} requests (batch size: {batch_size}, concurrency: {concurrency})")
 
     # Configure JSON schema validation based on provider support
-    if response_format:
-        litellm.enable_json_schema_validation = True
-    else:
-        litellm.enable_json_schema_validation = False
-    
-    litellm.drop_params = True
-
-    # Prepare messages for LLM API call
-    messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": "Analyze provided Threat Dragon model, generate threats and mitigations for elements and return a valid JSON following the rules."}
-        ]
+    litellm.enable_json_schema_validation = response_format
+
+    logger.info(f"Input token count (all requests): {sum(litellm.token_counter(model=model_name, messages=messages) for messages in requests)}")
+    # A batch's threats need far less than the model's output limit;
+    # the cap stops runaway generations early (reasoning tokens count towards it).
+    # Models unknown to LiteLLM (custom API bases, local servers) use the cap alone
+    max_tokens = int(os.getenv("LLM_MAX_TOKENS", "16000"))
+    try:
+        model_max_tokens = litellm.get_max_tokens(model=model_name)
+    except Exception:
+        model_max_tokens = None
+    if model_max_tokens:
+        max_tokens = min(model_max_tokens, max_tokens)
+
+    # Deployment settings live in a single router so every request
+    # reuses the same client, connection pool and retry policy. Each API base
+    # is a separate deployment; the router sends requests to the least busy
+    # one and fails over to the others on errors or timeouts
+    deployments = []
+    for api_base in api_bases or [None]:
+        deployment_params = {
+            "model": model_name,
+            "api_key": api_key,
+        }
 
-    logger.info(f"System token count: {litellm.token_counter(model=model_name, messages=messages)}")
-    max_tokens = litellm.get_max_tokens(model=model_name)
+        # Add custom API base URL if provided
+        if api_base:
+            deployment_params["api_base"] = api_base
 
-    # Build API completion parameters
+        deployments.append({"model_name": model_name, "litellm_params": deployment_params})
+
+    router = litellm.Router(
+        model_list=deployments,
+        routing_strategy="least-busy",
+        num_retries=2,
+        timeout=14400,
+    )
+
+    # Build API completion parameters shared by all requests
     completion_params = {
         "model": model_name,
-        "messages": messages,
         "temperature": temperature,
-        "timeout": 14400,
         "max_tokens": max_tokens,
-        "api_key": api_key,
+        "stream": stream,
     }
-    
+
     # Add structured output format if enabled
     if response_format:
         completion_params["response_format"] = AIThreatsResponseList
     else:
         completion_params["response_format"] = None
-    
-    # Add custom API base URL if provided
-    if api_base:
-        completion_params["api_base"] = api_base
-    
-    # Call LLM API
-    response = litellm.completion(**completion_params)
-
-    logger.info(f"Response cost: {response._hidden_params["response_cost"]}")
-    logger.debug(f"/\n\nResponse: {response}")
-    
+
+    # Cache keys are built from the same prompts minus the fields this tool writes back
+    cache_paths = [None] * len(batches)
+    if cache_dir:
+        key_model = _without_tool_fields(model)
+        cache_paths = [
+            cache_dir / f"{_cache_key(_build_messages(template, schema_json, key_model, batch), completion_params)}.json"
+            for batch in batches
+        ]
+
+    # Call LLM API for all batches, bounded by the concurrency limit. A failed
+    # batch does not cancel the others; its elements are reported as missing by the validator
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*[
+        _generate_batch_threats(router, batch, messages, completion_params, semaphore, cache_path, cache_ttl)
+        for batch, messages, cache_path in zip(batches, requests, cache_paths)
+    ], return_exceptions=True)
+
+    # Merge per-batch responses
+    threats_data = {}
+    total_cost = 0.0
+    errors = []
+    for batch, result in zip(batches, results):
+        if isinstance(result, Exception):
+            errors.append(result)
+            logger.error(f"Threat generation failed for elements {', '.join(batch)}: {result}")
+            logger.debug("Error details for elements %s", batch, exc_info=result)
+            continue
+        if isinstance(result, BaseException):
+            raise result
+        ai_response, cost = result
+        total_cost += cost
+        # Convert Pydantic models to dictionaries in a single dump per response
+        for item in ai_response.model_dump()['items']:
+            threats_data.setdefault(item['id'], []).extend(item['threats'])
+
+    # Nothing succeeded (e.g. invalid API key or model): surface the error to the caller
+    if errors and len(errors) == len(results):
+        raise errors[0]
+
+    logger.info(f"Response cost: {total_cost}")
+
+    total_threats = sum(len(threats) for threats in threats_data.values())
+    logger.info(f"Generated {total_threats} threats for {len(threats_data)} elements")
+
+    return threats_data
+
+
+async def _generate_batch_threats(router: litellm.Router, element_ids: List[str], messages: List[Dict], completion_params: Dict, semaphore: asyncio.Semaphore, cache_path: Path = None, cache_ttl: int = 0) -> tuple:
+    """Request threats for a batch of elements and return the parsed response with its cost."""
+    logger = logging.getLogger("threat_modeling.ai_client")
+    batch_label = ", ".join(element_ids)
+
+    # Reuse a cached response for an identical request
+    if cache_path:
+        cached = _read_cache(cache_path, cache_ttl)
+        if cached is not None:
+            logger.debug("Using cached response for elements %s: %s", batch_label, cache_path)
+            return cached, 0.0
+
+    async with semaphore:
+        logger.debug("Requesting threats for elements %s", batch_label)
+        response = await router.acompletion(messages=messages, **completion_params)
+
+        # Streamed responses are consumed while holding the slot
+        if completion_params.get("stream"):
+            content, response = await _read_stream(batch_label, response, messages)
+        else:
+            content = response.choices[0].message.content
+
+    cost = _response_cost(response)
+    logger.debug("/\n\nResponse for %s: %s", batch_label, response)
+
     # Parse and validate AI response
     try:
-        ai_response = AIThreatsResponseList.model_validate_json(response.choices[0].message.content)
+        ai_response = AIThreatsResponseList.model_validate_json(content)
     except Exception:
         # Fallback: try to extract JSON from markdown or plain text
-        logger.warning("LLM returned invalid JSON. Trying to extract JSON...")
-        match = re.search(r"\{.*\}", response.choices[0].message.content, re.S)
-        if match:
-            ai_response = AIThreatsResponseList.model_validate_json(match.group())
+        logger.warning(f"LLM returned invalid JSON for elements {batch_label}. Trying to extract JSON...")
+        json_text = _extract_json(content.decode('utf-8') if isinstance(content, bytes) else content)
+        if json_text:
+            ai_response = AIThreatsResponseList.model_validate_json(json_text)
         else:
             raise
-    
-    logger.debug(f"/\n\nAI Response: {ai_response}")
-    
-    # Convert Pydantic models to dictionaries
-    threats_data = {
-        item.id: [threat.model_dump() for threat in item.threats] 
-        for item in ai_response.items
-    }
-    
-    total_threats = sum(len(threats) for threats in threats_data.values())
-    logger.info(f"Generated {total_threats} threats for {len(threats_data)} elements")
-    
-    return threats_data
+
+    # Keep only the requested elements; threats for other elements would be merged once per request
+    requested = set(element_ids)
+    other_ids = [item.id for item in ai_response.items if item.id not in requested]
+    if other_ids:
+        logger.warning(f"LLM returned threats for elements outside the request for {batch_label}; ignoring: {', '.join(other_ids)}")
+        ai_response.items = [item for item in ai_response.items if item.id in requested]
+
+    logger.debug("/\n\nAI Response for %s: %s", batch_label, ai_response)
+
+    if cache_path:
+        _write_cache(cache_path, ai_response)
+
+    return ai_response, cost
+
+
+async def _read_stream(batch_label: str, stream, messages: List[Dict]) -> tuple:
+    """Accumulate a streamed completion and return its content (bytes) with the rebuilt response."""
+    logger = logging.getLogger("threat_modeling.ai_client")
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+
+    # Content is collected as UTF-8 bytes, which pydantic-core validates directly
+    chunks = []
+    buffer = bytearray()
+    async for chunk in stream:
+        chunks.append(chunk)
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            if not buffer:
+                logger.debug("First token for %s after %.2fs", batch_label, loop.time() - started)
+            buffer += delta.encode('utf-8')
+
+    return bytes(buffer), litellm.stream_chunk_builder(chunks, messages=messages)
+
+
+def _response_cost(response) -> float:
+    """Return the cost reported for a completion (0 when the provider pricing is unknown)."""
+    cost = response._hidden_params.get("response_cost")
+    if cost is None:
+        try:
+            cost = litellm.completion_cost(completion_response=response)
+        except Exception:
+            cost = 0.0
+    return cost or 0.0
+
+
+def _extract_json(text: str) -> Optional[str]:
+    """Return the first balanced JSON object in text (single pass, tracks string literals)."""
+    start = text.find('{')
+    if start == -1:
+        return None
+
+    depth = 0
+    in_string = escaped = False
+    for index in range(start, len(text)):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:index + 1]
+    return None
+
+
+def _read_cache(cache_path: Path, cache_ttl: int) -> Optional[AIThreatsResponseList]:
+    """Return a fresh cached response, or None on a miss (absent, expired or unreadable entry)."""
+    try:
+        if time.time() - cache_path.stat().st_mtime >= cache_ttl:
+            return None
+        return AIThreatsResponseList.model_validate_json(cache_path.read_bytes())
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.getLogger("threat_modeling.ai_client").warning(f"Ignoring unreadable cache entry {cache_path}: {e}")
+        return None
+
+
+def _write_cache(cache_path: Path, ai_response: AIThreatsResponseList) -> None:
+    """Store a response atomically so readers never see a partial entry (failures only skip caching)."""
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding='utf-8') as tmp_file:
+            tmp_file.write(ai_response.model_dump_json())
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.getLogger("threat_modeling.ai_client").warning(f"Could not write cache entry {cache_path}: {e}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def _cache_key(messages: List[Dict], completion_params: Dict) -> str:
+    """Hash everything that influences the LLM output into a response cache key."""
+    parts = [
+        completion_params["model"],
+        str(completion_params["temperature"]),
+        str(completion_params["response_format"] is not None),
+    ]
+    parts.extend(message["content"] for message in messages)
+    return hashlib.blake2b("\x00".join(parts).encode('utf-8'), digest_size=16).hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
+def _load_prompt_template() -> tuple:
+    """Read the prompt template once and split it into the static text around {schema_json} and {model_json}."""
+    template = PROMPT_FILE.read_text(encoding='utf-8')
+    prefix, rest = template.split('{schema_json}')
+    middle, suffix = rest.split('{model_json}')
+
+    # The template uses str.format escaping for literal braces
+    return tuple(part.replace('{{', '{').replace('}}', '}') for part in (prefix, middle, suffix))
+
+
+def _dumps(obj) -> str:
+    """Serialize an object to compact JSON for the prompt (whitespace only costs input tokens)."""
+    return orjson.dumps(obj).decode()
+
+
+def _build_messages(template: tuple, schema_json: str, model: Dict, element_ids: List[str]) -> List[Dict]:
+    """Build the system and user messages for one batch of elements."""
+    prefix, middle, suffix = template
+    return [
+        {"role": "system", "content": "".join((prefix, schema_json, middle, _dumps(_prompt_model(model, element_ids)), suffix))},
+        {"role": "user", "content": _user_message(element_ids)},
+    ]
+
+
+def _prompt_model(model: Dict, element_ids: List[str]) -> Dict:
+    """Return a copy of the model reduced to the neighbourhood of the given elements.
+
+    Each diagram keeps the requested elements, the flows connected to them, the
+    endpoints of those flows and all of its trust boundaries (needed to judge
+    containment and boundary crossings). Other cells are left out, diagrams
+    without requested elements are dropped and every kept cell is reduced to
+    the fields used by the prompt.
+    """
+    requested = set(element_ids)
+    detail = model.get('detail') or _EMPTY
+    diagrams = []
+    for diagram in detail.get('diagrams') or ():
+        cells = diagram.get('cells') or ()
+        keep = set()
+        for cell in cells:
+            cell_id = cell.get('id')
+            endpoints = _flow_endpoints(cell)
+            if cell_id and (cell_id in requested or not requested.isdisjoint(endpoints)):
+                keep.add(cell_id)
+                keep.update(endpoints)
+        if requested.isdisjoint(keep):
+            continue
+        diagrams.append({**diagram, 'cells': [
+            {key: cell[key] for key in PROMPT_CELL_FIELDS if key in cell}
+            for cell in cells
+            if cell.get('id') in keep or cell.get('shape') in TRUST_BOUNDARY_SHAPES
+        ]})
+    return {**model, 'detail': {**detail, 'diagrams': diagrams}}
+
+
+def _flow_endpoints(cell: Dict) -> tuple:
+    """Return the IDs of the cells a flow connects (empty for other shapes)."""
+    if cell.get('shape') != 'flow':
+        return ()
+    source = (cell.get('source') or _EMPTY).get('cell')
+    target = (cell.get('target') or _EMPTY).get('cell')
+    return tuple(cell_id for cell_id in (source, target) if cell_id)
+
+
+def _without_tool_fields(model: Dict) -> Dict:
+    """Return a copy of the model without the cell data written back by this tool (null data reads as empty)."""
+    detail = model.get('detail') or _EMPTY
+    diagrams = [
+        {**diagram, 'cells': [
+            {**cell, 'data': {key: value for key, value in (cell.get('data') or _EMPTY).items() if key not in TOOL_WRITTEN_FIELDS}}
+            for cell in diagram.get('cells') or ()
+        ]}
+        for diagram in detail.get('diagrams') or ()
+    ]
+    return {**model, 'detail': {**detail, 'diagrams': diagrams}}
+
+
+def _user_message(element_ids: List[str]) -> str:
+    """Build the request message naming the elements to analyze."""
+    ids = ", ".join(f'"{element_id}"' for element_id in element_ids)
+    return f"Analyze provided Threat Dragon model, generate threats and mitigations for the elements with ids {ids} only and return a valid JSON following the rules."
 
 
+def _get_in_scope_cell_ids(model: Dict) -> List[str]:
+    """Collect IDs of cells that should receive threats (threat-bearing shapes, not out of scope)."""
+    element_ids = []
+    for diagram in model.get('detail', {}).get('diagrams', []):
+        for cell in diagram.get('cells', []):
+            if cell.get('id') and is_threat_eligible(cell):
+                element_ids.append(cell['id'])
+    return element_ids
@@ -1,12 +1,15 @@
 """AI-Powered Threat Modeling Tool - Generate threats for Threat Dragon models using LLMs."""
 
 import os
+import queue
+import atexit
 import logging
+import logging.handlers
 import argparse
 from datetime import datetime
 from pathlib import Path
 from dotenv import load_dotenv
-from utils import load_json, update_threats_in_file, handle_user_friendly_error
+from utils import load_json, load_json_cached, save_json, update_threats, handle_user_friendly_error
 from ai_client import generate_threats
 from validator import ThreatValidator
 
@@ -20,6 +23,25 @@ load_dotenv(override=True)
 api_key = os.getenv('API_KEY')
 schema_file = "owasp.threat-dragon.schema.V2.json"
 
+# Log level the handlers are currently configured for (None until setup_logging runs)
+_configured_log_level = None
+
+# Background listener feeding the DEBUG log file (None unless DEBUG logging is configured)
+_log_listener = None
+
+
+def _stop_log_listener():
+    """Stop the DEBUG log listener, flushing queued records, and close its file handler."""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+
+atexit.register(_stop_log_listener)
+
 
 def parse_arguments():
     """Parse and validate command-line arguments."""
@@ -54,10 +76,17 @@ def parse_arguments():
         help='Enable structured JSON response format (default: False)'
     )
     
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='Stream LLM responses (default: False)'
+    )
+    
     parser.add_argument(
         '--api-base',
         type=str,
-        help='Custom API base URL (default: None)'
+        nargs='+',
+        help='Custom API base URL(s); multiple URLs are load-balanced with failover (default: None)'
     )
     
     parser.add_argument(
@@ -81,25 +110,45 @@ def parse_arguments():
 
 def setup_logging(log_level: str = 'INFO'):
     """Configure logging with both file and console handlers."""
+    global _configured_log_level, _log_listener
+
+    # Create logger instance (not root logger to avoid conflicts)
+    logger = logging.getLogger("threat_modeling")
+
+    # Repeated runs in the same process keep the existing handlers
+    if _configured_log_level == log_level.upper():
+        return logger
+    _configured_log_level = log_level.upper()
+
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     log_path = LOGS_DIR / f"threat_modeling_{timestamp}.log"
     LOGS_DIR.mkdir(parents=True, exist_ok=True)
 
-    # Create logger instance (not root logger to avoid conflicts)
-    logger = logging.getLogger("threat_modeling")
-    logger.setLevel(logging.DEBUG)
+    # Logger level follows the requested level so DEBUG records are not even created otherwise
+    logger.setLevel(logging.DEBUG if log_level.upper() == 'DEBUG' else logging.INFO)
     logger.propagate = False
+
+    # Release the handlers (and listener thread) of a previous configuration
+    for handler in logger.handlers:
+        handler.close()
     logger.handlers.clear()
+    _stop_log_listener()
 
-    # File handler: only enabled in DEBUG mode for detailed logs
+    # File handler: only enabled in DEBUG mode for detailed logs. Records are
+    # handed over through a queue so disk writes happen on a background thread
     if log_level.upper() == 'DEBUG':
-        file_handler = logging.FileHandler(str(log_path), encoding="utf-8")
+        file_handler = logging.FileHandler(str(log_path), encoding="utf-8", delay=True)
         file_handler.setLevel(logging.DEBUG)
         file_fmt = logging.Formatter("%(asctime)s - %(levelname)s - %(name)s - %(message)s")
         file_handler.setFormatter(file_fmt)
-        logger.addHandler(file_handler)
 
-    # Console handler: always enabled for INFO+ messages
+        log_queue = queue.Queue(-1)
+        _log_listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+        _log_listener.start()
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    # Console handler: always enabled for INFO+ messages (kept synchronous so
+    # output stays in order with the validation summary printed to stdout)
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
     console_fmt = logging.Formatter("%(message)s")
@@ -127,7 +176,8 @@ def main():
     logger.info(f"  Model File: {args.model_file}")
     logger.info(f"  Temperature: {args.temperature}")
     logger.info(f"  Response Format: {args.response_format}")
-    logger.info(f"  API Base: {args.api_base if args.api_base else 'None'}")
+    logger.info(f"  Stream: {args.stream}")
+    logger.info(f"  API Base: {', '.join(args.api_base) if args.api_base else 'None'}")
     logger.info(f"  Log Level: {args.log_level}")
     
     # Validate file paths
@@ -146,7 +196,7 @@ def main():
     # Load threat model and schema
     logger.info("Loading files...")
     try:
-        schema = load_json(schema_path)
+        schema = load_json_cached(schema_path)
         model = load_json(model_file_path)
     except Exception as e:
         error_msg = handle_user_friendly_error(e, "model_file", logger)
@@ -156,7 +206,7 @@ def main():
     # Generate threats using AI
     logger.info("Generating threats...")
     try:
-        threats_data = generate_threats(schema, model, args.llm_model, api_key, args.temperature, args.response_format, args.api_base)
+        threats_data = generate_threats(schema, model, args.llm_model, api_key, args.temperature, args.response_format, args.api_base, args.stream)
     except Exception as e:
         # Determine error type based on the exception
         error_str = str(e).lower()
@@ -180,14 +230,16 @@ def main():
         raise SystemExit(1)
     
     # Log detailed threat information (DEBUG only)
-    logger.debug("AI Response Details:")
-    for elem_id, threats in threats_data.items():
-        logger.debug(f"  Element {elem_id}: {len(threats)} threats")
-        for i, threat in enumerate(threats):
-            logger.debug(f"    Threat {i+1}: {threat.get('title', 'No title')} ({threat.get('severity', 'Unknown severity')}) - {threat.get('status', 'Unknown status')}")
-    
-    # Update threat model file with generated threats
-    update_threats_in_file(model_file_path, threats_data)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("AI Response Details:")
+        for elem_id, threats in threats_data.items():
+            logger.debug(f"  Element {elem_id}: {len(threats)} threats")
+            for i, threat in enumerate(threats):
+                logger.debug(f"    Threat {i+1}: {threat.get('title', 'No title')} ({threat.get('severity', 'Unknown severity')}) - {threat.get('status', 'Unknown status')}")
+    
+    # Update the loaded threat model with generated threats and write it back once
+    update_threats(model, threats_data)
+    save_json(model_file_path, model)
     logger.info(f"Updated model saved to {model_file_path}")
     
     # Validate AI response quality
@@ -195,14 +247,7 @@ def main():
     try:
         logger.info("Validating AI response...")
         validator = ThreatValidator(log_level=args.log_level)
-        
-        # Convert threats data to validation format
-        ai_response_format = [
-            {'id': elem_id, 'threats': threats} 
-            for elem_id, threats in threats_data.items()
-        ]
-        
-        validation_result = validator.validate_ai_response(model, ai_response_format, args.model_file)
+        validation_result = validator.validate_ai_response(model, threats_data, args.model_file)
         validator.print_summary(validation_result)
             
     except Exception as e:
@@ -1,18 +1,18 @@
 """Simplified Pydantic models for AI threat generation."""
 
 from pydantic import BaseModel, Field, RootModel
-from typing import List
+from typing import List, Literal
 
 
 class Threats(BaseModel):
     """Individual threat model."""
     title: str
-    status: str = Field(pattern=r"^(NA|Open|Mitigated)$")
-    severity: str = Field(pattern=r"^(High|Medium|Low)$")
+    status: Literal["NA", "Open", "Mitigated"]
+    severity: Literal["High", "Medium", "Low"]
     type: str
     description: str
     mitigation: str
-    modelType: str = Field(pattern=r"^(STRIDE|LINDDUN|CIA|DIEF|RANSOM|PLOT4ai|Generic)$")
+    modelType: Literal["STRIDE", "LINDDUN", "CIA", "DIEF", "RANSOM", "PLOT4ai", "Generic"]
 
 class AIThreatsResponse(BaseModel):
     """AI response for a single element."""
@@ -1,13 +1,24 @@
 """Utility functions for file operations and threat model updates."""
 
-import json
+import os
 import uuid
 import logging
+import functools
 from pathlib import Path
 from typing import Union
+import orjson
 
 logger = logging.getLogger(__name__)
 
+# Shapes that can carry threats (see prompt.txt rules); trust boundaries, text and other shapes never do
+THREAT_SHAPES = frozenset({'actor', 'process', 'store', 'flow'})
+
+# Shapes that mark trust zones (context for threats, never threat-bearing)
+TRUST_BOUNDARY_SHAPES = frozenset({'trust-boundary-box', 'trust-boundary-curve'})
+
+# Shared read-only default for missing or null objects (never mutate it)
+_EMPTY: dict = {}
+
 
 def handle_user_friendly_error(error: Exception, error_type: str, logger_instance: logging.Logger = None) -> str:
     """Convert technical errors into user-friendly messages while logging full details."""
@@ -56,60 +67,76 @@ def handle_user_friendly_error(error: Exception, error_type: str, logger_instanc
 def load_json(path: Union[str, Path]) -> dict:
     """Load and parse a JSON file."""
     logger.info(f"Loading JSON from {path}")
-    with open(str(path), 'r') as f:
-        return json.load(f)
+    return orjson.loads(Path(path).read_bytes())
 
 
-def update_threats_in_file(file_path: Union[str, Path], threats_data: dict) -> None:
-    """Update threat model file with AI-generated threats and visual indicators."""
-    logger.info(f"Updating threats in file: {file_path}")
-    
-    # Load existing threat model
-    with open(str(file_path), 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    
+def load_json_cached(path: Union[str, Path]) -> dict:
+    """Load a JSON file, reusing the parsed result until the file changes (callers must not mutate it)."""
+    path = str(path)
+    return _load_json_cached(path, os.stat(path).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_json_cached(path: str, mtime_ns: int) -> dict:
+    """Parse a JSON file; the modification time is part of the cache key."""
+    return load_json(path)
+
+
+def save_json(path: Union[str, Path], data: dict) -> None:
+    """Write data to a JSON file (2-space indented, UTF-8)."""
+    logger.info(f"Saving JSON to {path}")
+    Path(path).write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+
+def is_threat_eligible(cell: dict) -> bool:
+    """Return True if a cell should receive threats (threat-bearing shape and not out of scope)."""
+    return cell.get('shape') in THREAT_SHAPES and not (cell.get('data') or _EMPTY).get('outOfScope')
+
+
+def update_threats(data: dict, threats_data: dict) -> dict:
+    """Apply AI-generated threats and visual indicators to an in-memory threat model."""
     updated_count = 0
     
-    # Iterate through all diagrams and cells
-    for diagram in data.get('detail', {}).get('diagrams', []):
-        for cell in diagram.get('cells', []):
-            cell_id = cell.get('id')
-            
-            # Skip if this cell doesn't have generated threats
-            if cell_id in threats_data:
-                # Skip out-of-scope components and trust boundaries
-                if cell.get('data', {}).get('outOfScope') or cell.get('shape', '') in ['trust-boundary-box', 'trust-boundary-curve']:
-                    continue
-                
-                # Ensure cell has data object
-                if 'data' not in cell:
-                    cell['data'] = {}
-                
-                # Add unique IDs to threats if missing
-                threats_with_ids = []
-                for threat in threats_data[cell_id]:
-                    if 'id' not in threat:
-                        threat['id'] = str(uuid.uuid4())
-                    threats_with_ids.append(threat)
-                
-                # Update cell with new threats
-                cell['data']['threats'] = threats_with_ids
-                
-                # Update hasOpenThreats flag based on threat status
-                if 'hasOpenThreats' in cell['data']:
-                    cell['data']['hasOpenThreats'] = any(
-                        t.get('status', 'Open') == 'Open' for t in threats_data[cell_id]
-                    )
-                
-                # Add visual indicator (red stroke) for cells with threats
-                _add_red_stroke(cell)
-                updated_count += 1
-    
-    # Save updated model back to file
-    with open(str(file_path), 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, separators=(',', ': '), ensure_ascii=False)
+    # Index threat-eligible cells by ID in a single pass over all diagrams
+    cells_by_id = {
+        cell['id']: cell
+        for diagram in data.get('detail', {}).get('diagrams', [])
+        for cell in diagram.get('cells', [])
+        if 'id' in cell and is_threat_eligible(cell)
+    }
+    
+    # Visit only the cells that have generated threats
+    for cell_id, threats in threats_data.items():
+        cell = cells_by_id.get(cell_id)
+        if cell is None:
+            continue
+        
+        # Ensure cell has data object
+        cell_data = cell['data'] = cell.get('data') or {}
+        
+        # Add unique IDs to threats if missing and track open status in the same pass
+        threats_with_ids = []
+        has_open_threats = False
+        for threat in threats:
+            if 'id' not in threat:
+                threat['id'] = str(uuid.uuid4())
+            if threat.get('status', 'Open') == 'Open':
+                has_open_threats = True
+            threats_with_ids.append(threat)
+        
+        # Update cell with new threats
+        cell_data['threats'] = threats_with_ids
+        
+        # Update hasOpenThreats flag based on threat status
+        if 'hasOpenThreats' in cell_data:
+            cell_data['hasOpenThreats'] = has_open_threats
+        
+        # Add visual indicator (red stroke) for cells with threats
+        _add_red_stroke(cell)
+        updated_count += 1
     
     logger.info(f"Updated {updated_count} cells with threats")
+    return data
 
 
 def _add_red_stroke(cell: dict) -> None:
@@ -5,19 +5,53 @@ Validates AI-generated threat models against original specifications.
 Validation categories:
 - INFO: Missing elements (in scope but no threats generated)
 - WARNINGS: Quality issues (empty mitigations, out-of-scope elements)
-- ERRORS: No overlap with model elements
+- ERRORS: No overlap with model elements, or an empty response when elements are in scope
 """
 
-from datetime import datetime
+import sys
+import time
+import atexit
+import threading
 from pathlib import Path
 from typing import Dict, List
 from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from utils import _EMPTY, is_threat_eligible
 
 PROJECT_ROOT = Path(__file__).parent.parent
 LOGS_DIR = PROJECT_ROOT / "logs"
+VALIDATION_LOG_NAME = "validation.log"
 
+# Maximum number of response IDs listed in the validation log preview
+_PREVIEW_IDS = 50
 
-@dataclass
+# Serializes console output between the log writer thread (failures) and the caller
+_print_lock = threading.Lock()
+
+# Fixed part of every validation report, filled with %-formatting
+_LOG_HEADER = "THREAT VALIDATION LOG\n" + "="*60 + """
+Timestamp: %(timestamp)s
+Model File: %(filename)s
+
+VALIDATION NOTES:
+- Trust boundaries and other shapes that cannot carry threats are excluded from validation
+- Missing elements are informational, not errors
+- Invalid IDs (out of scope) are warnings, not errors
+- Only completely different IDs (no overlap with model) or an empty response are validation errors
+
+VALIDATION SUMMARY:
+Overall Status: %(status)s
+Elements in Scope: %(in_scope_elements)s
+Elements with Threats: %(elements_with_threats)s
+Total Threats Generated: %(total_threats)s
+Coverage: %(coverage_percent)s%%
+
+VALIDATION RESULTS:
+"""
+
+
+@dataclass(slots=True)
 class ValidationResult:
     """Container for validation results and statistics."""
     is_valid: bool
@@ -28,6 +62,39 @@ class ValidationResult:
     stats: Dict[str, int]
 
 
+def _error_message(result: ValidationResult) -> str:
+    """Describe why a validation result is invalid."""
+    if not result.stats['elements_with_threats']:
+        return "AI response is empty"
+    return "AI response contains completely different IDs with no overlap to model elements"
+
+
+def _render_log(result: ValidationResult, filename: str, threats_data: Dict[str, List[dict]], timestamp: str) -> str:
+    """Render a validation report for the log file."""
+    parts = [_LOG_HEADER % {
+        'timestamp': timestamp,
+        'filename': filename,
+        'status': '✅ VALID' if result.is_valid else '❌ INVALID',
+        **result.stats,
+    }]
+    
+    if not result.is_valid:
+        parts.append(f"\n❌ VALIDATION ERRORS:\n  • {_error_message(result)}\n")
+    
+    if result.warnings:
+        parts.append(f"\n⚠️  WARNINGS ({len(result.warnings)}):\n")
+        parts.extend(f"  • {warning}\n" for warning in result.warnings)
+    
+    if result.info:
+        parts.append(f"\nℹ️  INFO ({len(result.info)}):\n")
+        parts.extend(f"  • {info_item}\n" for info_item in result.info)
+    
+    response_ids = list(islice(threats_data, _PREVIEW_IDS))
+    more = f" ... (+{len(threats_data) - _PREVIEW_IDS} more)" if len(threats_data) > _PREVIEW_IDS else ""
+    parts.append(f"\nAI RESPONSE PREVIEW:\nTotal Responses: {len(threats_data)}\nResponse IDs: {response_ids}{more}\n\n")
+    return ''.join(parts)
+
+
 class ThreatValidator:
     """Validates AI-generated threat models against original specifications."""
     
@@ -35,31 +102,88 @@ class ThreatValidator:
         """Initialize the threat validator with log level and directory."""
         self.log_level = log_level
         self.logs_dir = logs_dir
+        # Cell scan of the most recently validated model: (model, in_scope_elements, all_elements)
+        self._last_scan = None
+        # Validation reports are appended to one log file, opened on first use
+        self.log_path = self.logs_dir / VALIDATION_LOG_NAME
+        self._log_handle = None
+        self._log_executor = None
         if self.log_level.upper() == 'DEBUG':
             self.logs_dir.mkdir(parents=True, exist_ok=True)
+            # Validation logs are written in the background; pending writes finish on close/exit
+            self._log_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="validation-log")
+            atexit.register(self.close)
     
-    def validate_ai_response(self, model: dict, ai_response: List[dict], filename: str) -> ValidationResult:
-        """Validate AI-generated threats against the original threat model."""
-        # Extract in-scope elements that should have threats
-        in_scope_elements = self._get_in_scope_elements(model)
-        ai_element_ids = {item['id'] for item in ai_response}
+    def close(self):
+        """Finish pending log writes and close the validation log file."""
+        if self._log_executor is not None:
+            self._log_executor.shutdown(wait=True)
+            self._log_executor = None
+            atexit.unregister(self.close)
+        self._close_log_handle()
+    
+    def rotate(self):
+        """Move the current validation log aside to a timestamped file; later reports start a new log."""
+        if self._log_executor is not None:
+            self._log_executor.submit(self._rotate_log).result()
+        else:
+            self._rotate_log()
+    
+    def _rotate_log(self):
+        """Close the log handle and rename the log file (runs on the log writer thread)."""
+        self._close_log_handle()
+        if self.log_path.exists():
+            timestamp = time.strftime("%Y%m%d_%H%M%S")
+            target = self.log_path.with_name(f"validation_log_{timestamp}.log")
+            # Rotations within the same second get a counter; rename would replace an existing log
+            counter = 1
+            while target.exists():
+                target = self.log_path.with_name(f"validation_log_{timestamp}_{counter}.log")
+                counter += 1
+            self.log_path.rename(target)
+    
+    def _close_log_handle(self):
+        """Flush and close the validation log file if it is open."""
+        if self._log_handle is not None:
+            self._log_handle.close()
+            self._log_handle = None
+    
+    def validate_ai_response(self, model: dict, threats_data: Dict[str, List[dict]], filename: str) -> ValidationResult:
+        """Validate AI-generated threats (element ID -> threats) against the original threat model."""
+        # An empty response (e.g. nothing parseable from the LLM) skips the set comparisons and
+        # quality checks; it is invalid only if the model has elements that should have threats
+        if not threats_data:
+            in_scope_elements, _ = self._scan_cells(model)
+            missing_elements = sorted(in_scope_elements)
+            result = ValidationResult(
+                is_valid=not in_scope_elements,
+                missing_elements=missing_elements,
+                invalid_ids=[],
+                warnings=[],
+                info=[f"Element {elem_id} is in scope but has no threats" for elem_id in missing_elements],
+                stats=self._calculate_stats(in_scope_elements, set(), threats_data)
+            )
+            self._submit_log(result, filename, threats_data)
+            return result
+        
+        # Extract in-scope elements that should have threats and all model elements in one pass
+        in_scope_elements, all_model_elements = self._scan_cells(model)
+        ai_element_ids = set(threats_data)
         
         # Identify missing and out-of-scope elements
-        missing_elements = [elem_id for elem_id in in_scope_elements if elem_id not in ai_element_ids]
-        out_of_scope_elements = [elem_id for elem_id in ai_element_ids if elem_id not in in_scope_elements]
+        missing_elements = sorted(in_scope_elements - ai_element_ids)
+        out_of_scope_elements = sorted(ai_element_ids - in_scope_elements)
         
         # Check if AI completely failed (no overlap with model at all)
-        all_model_elements = self._get_all_model_elements(model)
-        has_overlap = len(ai_element_ids.intersection(all_model_elements)) > 0
-        completely_unrelated = not has_overlap and len(ai_element_ids) > 0
+        completely_unrelated = bool(ai_element_ids) and ai_element_ids.isdisjoint(all_model_elements)
         
         # Collect quality warnings
-        warnings = self._check_threat_quality(ai_response)
+        warnings = self._check_threat_quality(threats_data)
         warnings.extend([f"Element {elem_id} is not in scope but has threats" for elem_id in out_of_scope_elements])
         
         # Collect informational messages
         info = [f"Element {elem_id} is in scope but has no threats" for elem_id in missing_elements]
-        stats = self._calculate_stats(in_scope_elements, ai_element_ids, ai_response)
+        stats = self._calculate_stats(in_scope_elements, ai_element_ids, threats_data)
         
         # Create validation result
         result = ValidationResult(
@@ -71,46 +195,49 @@ class ThreatValidator:
             stats=stats
         )
         
-        # Write detailed log if in DEBUG mode
-        self._write_log(result, filename, ai_response)
+        # Write detailed log in the background if in DEBUG mode
+        self._submit_log(result, filename, threats_data)
         return result
     
-    def _get_in_scope_elements(self, model: dict) -> List[str]:
-        """Extract element IDs that should have threats generated (in-scope, not trust boundaries)."""
-        elements = []
-        for diagram in model.get('detail', {}).get('diagrams', []):
-            for cell in diagram.get('cells', []):
+    def reset(self):
+        """Forget the cached cell scan (call after mutating a model that was already validated)."""
+        self._last_scan = None
+    
+    def _scan_cells(self, model: dict) -> tuple:
+        """Return (in-scope element IDs, all element IDs) from a single pass over the model cells (memoized for the last model)."""
+        if self._last_scan is not None and self._last_scan[0] is model:
+            return self._last_scan[1], self._last_scan[2]
+        
+        in_scope_elements = set()
+        all_elements = set()
+        diagrams = (model.get('detail') or _EMPTY).get('diagrams') or ()
+        for diagram in diagrams:
+            for cell in diagram.get('cells') or ():
                 cell_id = cell.get('id')
-                cell_data = cell.get('data', {})
-                cell_shape = cell.get('shape', '')
+                if not cell_id:
+                    continue
+                all_elements.add(cell_id)
                 
-                # Include if: in scope, not trust boundary, has ID
-                if cell_id and not cell_data.get('outOfScope', False) and cell_shape not in ['trust-boundary-box', 'trust-boundary-curve']:
-                    elements.append(cell_id)
+                # Include if: threat-bearing shape, in scope (same rule as threat generation)
+                if is_threat_eligible(cell):
+                    in_scope_elements.add(cell_id)
         
-        return elements
-    
-    def _get_all_model_elements(self, model: dict) -> set:
-        """Extract all element IDs from the model (including out-of-scope elements)."""
-        all_elements = set()
-        for diagram in model.get('detail', {}).get('diagrams', []):
-            for cell in diagram.get('cells', []):
-                if cell.get('id'):
-                    all_elements.add(cell.get('id'))
-        return all_elements
+        # Only the last model is kept, so validating many models does not pin them all in memory
+        self._last_scan = (model, in_scope_elements, all_elements)
+        return in_scope_elements, all_elements
     
-    def _check_threat_quality(self, ai_response: List[dict]) -> List[str]:
+    def _check_threat_quality(self, threats_data: Dict[str, List[dict]]) -> List[str]:
         """Check threat quality and return warnings for issues (e.g., empty mitigations)."""
-        warnings = []
-        for item in ai_response:
-            for i, threat in enumerate(item.get('threats', [])):
-                if not threat.get('mitigation', '').strip():
-                    warnings.append(f"Element {item['id']} threat {i+1} has empty mitigation")
-        return warnings
-    
-    def _calculate_stats(self, in_scope_elements: List[str], ai_element_ids: set, ai_response: List[dict]) -> Dict[str, int]:
+        return [
+            f"Element {elem_id} threat {i} has empty mitigation"
+            for elem_id, threats in threats_data.items()
+            for i, threat in enumerate(threats, start=1)
+            if not (threat.get('mitigation') or '').strip()
+        ]
+    
+    def _calculate_stats(self, in_scope_elements: set, ai_element_ids: set, threats_data: Dict[str, List[dict]]) -> Dict[str, int]:
         """Calculate validation statistics (coverage, threats count, etc.)."""
-        total_threats = sum(len(item.get('threats', [])) for item in ai_response)
+        total_threats = sum(map(len, threats_data.values()))
         coverage = (len(ai_element_ids) / len(in_scope_elements) * 100) if in_scope_elements else 0
         
         return {
@@ -120,89 +247,63 @@ class ThreatValidator:
             'coverage_percent': round(coverage, 1)
         }
     
-    def _write_log(self, result: ValidationResult, filename: str, ai_response: List[dict]):
+    def _submit_log(self, result: ValidationResult, filename: str, threats_data: Dict[str, List[dict]]):
+        """Queue a report for the log writer thread and announce the log path (DEBUG mode only)."""
+        if self._log_executor is None:
+            return
+        self._log_executor.submit(self._write_log, result, filename, threats_data)
+        # Printed here rather than by the writer so it keeps its place before the summary
+        with _print_lock:
+            print(f"Validation log appended to: {self.log_path}")
+    
+    def _write_log(self, result: ValidationResult, filename: str, threats_data: Dict[str, List[dict]]):
         """Write detailed validation log to file (only in DEBUG mode)."""
         if self.log_level.upper() != 'DEBUG':
             return
         
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename_only = Path(filename).name
-        log_path = self.logs_dir / f"validation_log_{filename_only.replace('.json', '')}_{timestamp}.log"
-        
-        content = f"""THREAT VALIDATION LOG
-{'='*60}
-Timestamp: {timestamp}
-Model File: {filename}
-
-VALIDATION NOTES:
-- Trust boundary boxes and curves are excluded from validation
-- Missing elements are informational, not errors
-- Invalid IDs (out of scope) are warnings, not errors
-- Only completely different IDs (no overlap with model) are validation errors
-
-VALIDATION SUMMARY:
-Overall Status: {'✅ VALID' if result.is_valid else '❌ INVALID'}
-Elements in Scope: {result.stats['in_scope_elements']}
-Elements with Threats: {result.stats['elements_with_threats']}
-Total Threats Generated: {result.stats['total_threats']}
-Coverage: {result.stats['coverage_percent']}%
-
-VALIDATION RESULTS:
-"""
-        
-        if not result.is_valid:
-            content += f"\n❌ VALIDATION ERRORS:\n"
-            content += f"  • AI response contains completely different IDs with no overlap to model elements\n"
-        
-        if result.warnings:
-            content += f"\n⚠️  WARNINGS ({len(result.warnings)}):\n"
-            for warning in result.warnings:
-                content += f"  • {warning}\n"
-        
-        if result.info:
-            content += f"\nℹ️  INFO ({len(result.info)}):\n"
-            for info_item in result.info:
-                content += f"  • {info_item}\n"
-        
-        content += f"\nAI RESPONSE PREVIEW:\n"
-        content += f"Total Responses: {len(ai_response)}\n"
-        content += f"Response IDs: {[item.get('id') for item in ai_response]}\n"
+        content = _render_log(result, filename, threats_data, time.strftime("%Y%m%d_%H%M%S"))
         
         try:
-            with open(str(log_path), 'w', encoding='utf-8') as f:
-                f.write(content)
-            print(f"Validation log saved to: {log_path}")
+            # The handle stays open between reports; each report is flushed so it is visible immediately
+            if self._log_handle is None:
+                self._log_handle = open(str(self.log_path), 'a', encoding='utf-8')
+            self._log_handle.write(content)
+            self._log_handle.flush()
         except Exception as e:
-            print(f"Failed to save validation log: {str(e)}")
+            with _print_lock:
+                print(f"Failed to save validation log: {str(e)}")
     
     def print_summary(self, result: ValidationResult):
         """Print a formatted validation summary to console."""
-        print("\n" + "="*60)
-        print("THREAT VALIDATION SUMMARY")
-        print("="*60)
-        print("Note: Trust boundary boxes and curves are excluded from validation")
-        print("Note: Missing elements are informational, not errors")
-        print("Note: Invalid IDs (out of scope) are warnings, not errors")
-        print("Note: Only completely different IDs are validation errors")
-        
-        print(f"Overall Status: {'✅ VALID' if result.is_valid else '❌ INVALID'}")
-        print(f"Elements in Scope: {result.stats['in_scope_elements']}")
-        print(f"Elements with Threats: {result.stats['elements_with_threats']}")
-        print(f"Coverage: {result.stats['coverage_percent']}%")
-        print(f"Total Threats Generated: {result.stats['total_threats']}")
+        lines = [
+            "\n" + "="*60,
+            "THREAT VALIDATION SUMMARY",
+            "="*60,
+            "Note: Trust boundaries and other shapes that cannot carry threats are excluded from validation",
+            "Note: Missing elements are informational, not errors",
+            "Note: Invalid IDs (out of scope) are warnings, not errors",
+            "Note: Only completely different IDs or an empty response are validation errors",
+            f"Overall Status: {'✅ VALID' if result.is_valid else '❌ INVALID'}",
+            f"Elements in Scope: {result.stats['in_scope_elements']}",
+            f"Elements with Threats: {result.stats['elements_with_threats']}",
+            f"Coverage: {result.stats['coverage_percent']}%",
+            f"Total Threats Generated: {result.stats['total_threats']}",
+        ]
         
         if not result.is_valid:
-            print(f"\n❌ VALIDATION ERRORS:")
-            print(f"  • AI response contains completely different IDs with no overlap to model elements")
+            lines.append("\n❌ VALIDATION ERRORS:")
+            lines.append(f"  • {_error_message(result)}")
         
         if result.warnings:
-            print(f"\n⚠️  WARNINGS ({len(result.warnings)}):")
-            for warning in result.warnings:
-                print(f"  • {warning}")
+            lines.append(f"\n⚠️  WARNINGS ({len(result.warnings)}):")
+            lines.extend(f"  • {warning}" for warning in result.warnings)
         
         if result.info:
-            print(f"\nℹ️  INFO ({len(result.info)}):")
-            for info_item in result.info:
-                print(f"  • {info_item}")
+            lines.append(f"\nℹ️  INFO ({len(result.info)}):")
+            lines.extend(f"  • {info_item}" for info_item in result.info)
+        
+        lines.append("="*60)
         
-        print("="*60)
\ No newline at end of file
+        # Emit the whole summary with a single write
+        with _print_lock:
+            sys.stdout.write("\n".join(lines) + "\n")